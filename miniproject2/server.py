@@ -2,6 +2,15 @@ from flask import Flask, request, jsonify  # Import Flask for web framework
 from base64 import b64decode  # Import base64 decoding function
 from Crypto.Cipher import AES  # Import AES encryption module
 import json  # Import JSON handling module
+import os  # Import OS module for file and environment access
+import gzip  # Import gzip module for batch compression
+import random  # Import random module for backoff jitter
+import threading  # Import threading module for background workers
+import time  # Import time module for timing and sleeps
+import urllib.request  # Import urllib for upstream HTTP requests
+import urllib.error  # Import urllib errors to tell rejected batches from outages
+import socket  # Import socket module for the default gateway id
+import uuid  # Import uuid module for spool ids
 
 # Initialize Flask application
 app = Flask(__name__)
@@ -14,6 +23,31 @@ aes_key = bytes([
     0x35, 0x36, 0x37, 0x38, 0x39, 0x30, 0x31, 0x32
 ])
 
+# Edge gateway configuration (override with environment variables)
+SPOOL_DIR = os.environ.get('SPOOL_DIR', 'spool')  # Directory of append-only spool segments of validated readings
+CHECKPOINT_FILE = os.environ.get('CHECKPOINT_FILE', 'spool.offset')  # Segment id and offset already forwarded upstream
+DEAD_LETTER_FILE = os.environ.get('DEAD_LETTER_FILE', 'spool.dead.jsonl')  # Batches the central server rejected as invalid
+GATEWAY_ID = os.environ.get('GATEWAY_ID', socket.gethostname())  # Prefix of the reading ids sent upstream
+UPSTREAM_URL = os.environ.get('UPSTREAM_URL', 'http://central-server:8888/api/ingest-batch')  # Central ingest API
+SEGMENT_MAX_BYTES = 1024 * 1024  # Start a new spool segment once the current one reaches this size
+SEGMENT_MAX_AGE = 60  # ...or is this many seconds old, so forwarded segments can be deleted
+FSYNC_BATCH_SIZE = 50  # fsync the spool after this many appended readings
+FSYNC_INTERVAL = 1.0  # ...or after this many seconds, whichever comes first
+BATCH_MAX_RECORDS = 500  # Maximum readings coalesced into one upstream batch
+FORWARD_INTERVAL = 5  # Seconds between forwarding cycles when the spool is drained
+UPSTREAM_TIMEOUT = 10  # Seconds to wait for the central server to answer
+RETRY_BASE_DELAY = 1  # First retry delay in seconds, doubled after each failure
+RETRY_MAX_DELAY = 60  # Upper bound for the retry delay in seconds
+PERMANENT_HTTP_ERRORS = {400, 413, 422}  # Upstream replies that will not change on retry; all others are retried
+
+# Spool state shared between the request handlers and the background workers
+spool_lock = threading.Lock()
+spool_handle = None
+spool_segment = None
+segment_opened_at = time.monotonic()
+unsynced_records = 0
+last_fsync = time.monotonic()
+
 """
 Decrypts an AES-256 encrypted Base64-encoded string.
 
@@ -52,6 +86,310 @@ def decrypt_aes(cipher_text):
         return None  # Return None to indicate failure
 
 
+"""
+Builds the path of a spool segment file.
+
+:param segment_id: The id of the segment.
+:return: The path of the segment file inside SPOOL_DIR.
+"""
+def segment_path(segment_id):
+    return os.path.join(SPOOL_DIR, f"segment-{segment_id}.jsonl")
+
+
+"""
+Lists the spool segments, oldest first.
+
+:return: Sorted list of segment ids.
+"""
+def list_segments():
+    if not os.path.isdir(SPOOL_DIR):
+        return []
+    return sorted(
+        name[len("segment-"):-len(".jsonl")]
+        for name in os.listdir(SPOOL_DIR)
+        if name.startswith("segment-") and name.endswith(".jsonl")
+    )
+
+
+"""
+Creates the id of the next spool segment.
+
+Ids start with a sequence number one past the newest known segment, so
+they sort in write order. The random suffix keeps reading ids unique
+even if the spool directory and checkpoint are lost.
+
+:return: The new segment id.
+"""
+def new_segment_id():
+    known = list_segments() + [read_checkpoint()[0]]
+    sequence = max((int(segment_id.split('-')[0]) for segment_id in known if segment_id), default=0)
+    return f"{sequence + 1:012d}-{uuid.uuid4().hex[:8]}"
+
+
+"""
+Truncates a spool segment back to its last newline.
+
+A crash in the middle of a write leaves a final line without a newline;
+forwarding would otherwise stop at that fragment.
+
+:param path: The path of the segment file.
+"""
+def repair_segment(path):
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            chunk_start = max(0, position - 4096)
+            f.seek(chunk_start)
+            newline = f.read(position - chunk_start).rfind(b"\n")
+            if newline != -1:
+                position = chunk_start + newline + 1
+                break
+            position = chunk_start
+        if position != end:
+            print(f"Dropping {end - position} bytes of partially written spool data")
+            f.truncate(position)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+"""
+Seals the current spool segment and starts a new one.
+Must be called with spool_lock held.
+"""
+def rotate_spool():
+    global spool_handle, spool_segment, segment_opened_at
+    if spool_handle is not None:
+        sync_spool()
+        spool_handle.close()
+    spool_segment = new_segment_id()
+    spool_handle = open(segment_path(spool_segment), 'ab')
+    segment_opened_at = time.monotonic()
+
+
+"""
+Opens the spool if it is not open yet.
+
+The first open repairs a partially written last line in the newest
+segment left by a previous run, then always starts a fresh segment.
+Must be called with spool_lock held.
+
+:return: The open binary file handle of the current segment.
+"""
+def open_spool():
+    if spool_handle is None:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        segments = list_segments()
+        if segments:
+            repair_segment(segment_path(segments[-1]))
+        rotate_spool()
+    return spool_handle
+
+
+"""
+Flushes buffered spool writes to disk with a single fsync.
+Must be called with spool_lock held.
+"""
+def sync_spool():
+    global unsynced_records, last_fsync
+    if spool_handle is not None and unsynced_records:
+        spool_handle.flush()
+        os.fsync(spool_handle.fileno())
+    unsynced_records = 0
+    last_fsync = time.monotonic()
+
+
+"""
+Appends one validated reading to the local spool.
+
+Writes are only fsynced every FSYNC_BATCH_SIZE readings or FSYNC_INTERVAL
+seconds, so a power loss can drop at most that window of readings.
+
+:param data: The validated sensor reading dictionary.
+"""
+def append_to_spool(data):
+    global unsynced_records
+    line = (json.dumps(data, separators=(',', ':')) + "\n").encode('utf-8')
+    with spool_lock:
+        handle = open_spool()
+        if handle.tell() >= SEGMENT_MAX_BYTES or time.monotonic() - segment_opened_at >= SEGMENT_MAX_AGE:
+            rotate_spool()
+            handle = spool_handle
+        handle.write(line)
+        unsynced_records += 1
+        if unsynced_records >= FSYNC_BATCH_SIZE or time.monotonic() - last_fsync >= FSYNC_INTERVAL:
+            sync_spool()
+
+
+"""
+Background worker: fsyncs readings that arrived since the last fsync
+so a quiet period does not leave them only in the page cache.
+"""
+def periodic_sync():
+    while True:
+        time.sleep(FSYNC_INTERVAL)
+        with spool_lock:
+            sync_spool()
+
+
+"""
+Reads the segment id and the offset in it that has already been forwarded upstream.
+
+:return: Tuple of (segment id, byte offset), or (None, 0) if no checkpoint exists yet.
+"""
+def read_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE, 'r') as f:
+            segment_id, offset = f.read().split()
+            return segment_id, int(offset)
+    except (FileNotFoundError, ValueError):
+        return None, 0
+
+
+"""
+Atomically replaces the checkpoint with a new segment id and offset.
+
+:param segment_id: The id of the segment being forwarded.
+:param offset: The byte offset up to which the segment has been forwarded.
+"""
+def write_checkpoint(segment_id, offset):
+    tmp_file = CHECKPOINT_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(f"{segment_id} {offset}")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+
+"""
+Reads the next batch of complete readings from a spool segment.
+
+Each reading gets a reading_id built from the gateway id, the segment id
+and its line offset, so the central server can ignore re-sent readings.
+
+:param segment_id: The id of the segment to read.
+:param offset: The byte offset to start reading from.
+:return: Tuple of (list of readings, offset just past the last reading read).
+"""
+def read_batch(segment_id, offset):
+    readings = []
+    with open(segment_path(segment_id), 'rb') as f:
+        f.seek(offset)
+        while len(readings) < BATCH_MAX_RECORDS:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break  # End of spool or a partially written last line
+            line_offset = offset
+            offset += len(line)
+            try:
+                reading = json.loads(line)
+            except ValueError:
+                print("Skipping corrupt spool line at offset", line_offset)
+                continue
+            reading["reading_id"] = f"{GATEWAY_ID}:{segment_id}:{line_offset}"
+            readings.append(reading)
+    return readings, offset
+
+
+"""
+Sends one gzip-compressed batch of readings to the central server.
+
+:param readings: List of sensor reading dictionaries.
+:raises urllib.error.HTTPError: If the upstream returns an error status.
+:raises Exception: If the upstream request fails.
+"""
+def post_batch(readings):
+    body = gzip.compress(json.dumps({"readings": readings}).encode('utf-8'))
+    upstream_request = urllib.request.Request(
+        UPSTREAM_URL,
+        data=body,
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        method='POST'
+    )
+    with urllib.request.urlopen(upstream_request, timeout=UPSTREAM_TIMEOUT) as response:
+        if not 200 <= response.status < 300:
+            raise Exception(f"Upstream returned HTTP {response.status}")
+
+
+"""
+Appends a batch the central server rejected to the dead-letter file,
+so dropped readings can still be inspected and replayed by hand.
+
+:param readings: List of sensor reading dictionaries.
+:param status: The HTTP status code the central server returned.
+"""
+def dead_letter(readings, status):
+    with open(DEAD_LETTER_FILE, 'ab') as f:
+        for reading in readings:
+            f.write((json.dumps({"status": status, "reading": reading}, separators=(',', ':')) + "\n").encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+"""
+Background worker: forwards spooled readings upstream in batches.
+
+Segments are forwarded oldest first and progress is tracked in
+CHECKPOINT_FILE, so after a restart forwarding resumes where it stopped.
+A sealed segment is deleted as soon as it has been forwarded, so disk
+use stays bounded by the backlog plus the current segment. Delivery is at-least-once: a crash between a
+successful upload and the checkpoint write re-sends that batch, and the
+central server drops the repeated reading ids.
+"""
+def forward_spool():
+    failures = 0
+    while True:
+        try:
+            with spool_lock:
+                sync_spool()  # Only forward readings that are durable locally
+            segment_id, offset = read_checkpoint()
+            segments = list_segments()
+
+            # Segments before the checkpoint were forwarded but not deleted before a crash
+            if segment_id is not None:
+                for old_segment in [old for old in segments if old < segment_id]:
+                    os.remove(segment_path(old_segment))
+                segments = [current for current in segments if current >= segment_id]
+            if not segments:
+                time.sleep(FORWARD_INTERVAL)
+                continue
+            if segment_id != segments[0]:
+                segment_id, offset = segments[0], 0
+
+            size = os.path.getsize(segment_path(segment_id))
+            readings, next_offset = read_batch(segment_id, offset) if size > offset else ([], offset)
+            if readings:
+                try:
+                    post_batch(readings)
+                    print(f"Forwarded {len(readings)} readings upstream")
+                except urllib.error.HTTPError as e:
+                    if e.code not in PERMANENT_HTTP_ERRORS:
+                        raise  # Wrong URL, auth, rate limit, redirects and 5xx are retried with backoff
+                    # The batch itself is invalid; move it aside so it cannot block the spool
+                    dead_letter(readings, e.code)
+                    print(f"Upstream rejected batch with HTTP {e.code}, moved {len(readings)} readings to {DEAD_LETTER_FILE}")
+            if next_offset != offset:
+                write_checkpoint(segment_id, next_offset)
+            failures = 0
+
+            if next_offset == offset:
+                if len(segments) > 1:
+                    # A newer segment exists, so this one is sealed and fully forwarded
+                    if next_offset < size:
+                        print(f"Dropping {size - next_offset} bytes of incomplete data at the end of segment {segment_id}")
+                    write_checkpoint(segments[1], 0)
+                    os.remove(segment_path(segment_id))
+                else:
+                    time.sleep(FORWARD_INTERVAL)  # Caught up with the current segment
+        except Exception as e:
+            # Exponential backoff with jitter while the central server is unreachable
+            failures += 1
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            print(f"Forwarding Error (attempt {failures}), retrying in {delay:.1f}s:", str(e))
+            time.sleep(delay)
+
+
 """
 Flask route to handle incoming POST requests with encrypted sensor data.
 
@@ -80,10 +418,19 @@ def receive_data():
         # Define required JSON fields
         required_fields = ["team_number", "temperature", "humidity", "timestamp"]
 
-        # Validate that all required fields exist in the received data
+        # Validate that the data is a JSON object
+        if not isinstance(data, dict):
+            return jsonify({"error": "Invalid data format"}), 400
+
+        # Validate that all required fields exist and are numeric, so the central server can store them
         for field in required_fields:
             if field not in data:
                 return jsonify({"error": f"Missing field: {field}"}), 400  # Return error if a field is missing
+            if isinstance(data[field], bool) or not isinstance(data[field], (int, float)):
+                return jsonify({"error": f"Invalid value for field: {field}"}), 400  # Return error if a field is not numeric
+
+        # Persist the reading to the local spool for forwarding upstream
+        append_to_spool(data)
 
         # Print successfully received and parsed data
         print(f"Data Stored: Team Number: {data['team_number']}, Temperature: {data['temperature']}°C, Humidity: {data['humidity']}%, Timestamp: {data['timestamp']}")
@@ -98,7 +445,16 @@ def receive_data():
 
 
 """
-Main entry point: Starts the Flask server on port 8888, accessible to all network devices.
+Main entry point: Starts the spool workers and the Flask server on port 8888, accessible to all network devices.
 """
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8888, debug=True)  # Start Flask server on port 8888
+    # Repair the spool and start a new segment before anything is appended or forwarded
+    with spool_lock:
+        open_spool()
+
+    # Start the background fsync and forwarding workers
+    threading.Thread(target=periodic_sync, daemon=True).start()
+    threading.Thread(target=forward_spool, daemon=True).start()
+
+    # The reloader would start a second process forwarding the same spool, so it is disabled
+    app.run(host='0.0.0.0', port=8888, debug=True, use_reloader=False)  # Start Flask server on port 8888
@@ -1,6 +1,5 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, Blueprint, request, jsonify, current_app
 from base64 import b64decode  # Import base64 decoding function
-from Crypto.Cipher import AES  # Import AES encryption module
 import json  # Import JSON handling module
 import sqlite3  # Import SQLite3 database module
 import re # Import regular expression module
@@ -8,74 +7,102 @@ import logging
 import os
 from datetime import datetime, timedelta
 import shutil
+import zlib
 import threading
 import time
-from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
-from routes.auth import auth
-from models.user import User
-from database import db
-
-# 配置日志
-logging.basicConfig(
-    level=logging.DEBUG,  # 改为DEBUG级别以显示更多信息
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('esp32_server.log', mode='a', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+
+# 重量级依赖（flask_cors、flask_sqlalchemy、pycryptodome、模型和蓝图）在 create_app
+# 或首次使用时才导入，测试和命令行工具可以低成本地导入本模块
 logger = logging.getLogger(__name__)
 
-# 设置Flask的日志级别
-logging.getLogger('werkzeug').setLevel(logging.DEBUG)
-
-# Initialize Flask application
-app = Flask(__name__)
-
-# 配置 CORS
-CORS(app, 
-     resources={r"/*": {
-         "origins": ["http://localhost:3000"],
-         "methods": ["GET", "POST", "OPTIONS"],
-         "allow_headers": ["Content-Type", "Authorization", "Accept"],
-         "expose_headers": ["Content-Type", "Authorization"],
-         "supports_credentials": True,
-         "max_age": 3600
-     }},
-     supports_credentials=True
-)
-
-# 配置
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///esp32.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SESSION_COOKIE_SECURE'] = False  # 开发环境设置为 False
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-
-# 初始化数据库
-db.init_app(app)
-
-# 注册蓝图
-app.register_blueprint(auth, url_prefix='/api/auth')
-
-# 添加全局错误处理
-@app.errorhandler(404)
+# 传感器数据接口蓝图，由 create_app 注册
+sensor = Blueprint('sensor', __name__)
+
+def configure_logging():
+    """配置日志（重复调用无副作用）"""
+    logging.basicConfig(
+        level=logging.DEBUG,  # 改为DEBUG级别以显示更多信息
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('esp32_server.log', mode='a', encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+
+    # 设置Flask的日志级别
+    logging.getLogger('werkzeug').setLevel(logging.DEBUG)
+
+def create_app(config=None, warm=True):
+    """应用工厂：创建并配置 Flask 应用，执行数据库迁移和预热
+
+    python server.py 和 gunicorn 等 WSGI 服务器都通过它启动；
+    测试和命令行工具可传入 warm=False 跳过预热。
+    """
+    from flask_cors import CORS
+    from database import db
+    from routes.auth import auth
+
+    configure_logging()
+
+    # Initialize Flask application
+    app = Flask(__name__)
+
+    # 配置 CORS
+    CORS(app, 
+         resources={r"/*": {
+             "origins": ["http://localhost:3000"],
+             "methods": ["GET", "POST", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization", "Accept"],
+             "expose_headers": ["Content-Type", "Authorization"],
+             "supports_credentials": True,
+             "max_age": 3600
+         }},
+         supports_credentials=True
+    )
+
+    # 配置（传感器数据和用户表共用同一个数据库文件）
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SESSION_COOKIE_SECURE'] = False  # 开发环境设置为 False
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['READY'] = False
+    app.config['DB_NAME'] = DB_NAME
+    if config:
+        app.config.update(config)
+
+    # 传感器数据和用户表共用 DB_NAME 指定的数据库文件
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(app.config['DB_NAME'])
+
+    # 初始化数据库
+    db.init_app(app)
+
+    # 注册蓝图
+    app.register_blueprint(auth, url_prefix='/api/auth')
+    app.register_blueprint(sensor)
+
+    # 添加全局错误处理
+    app.register_error_handler(404, not_found_error)
+    app.register_error_handler(500, internal_error)
+    app.after_request(after_request)
+
+    migrate_database(app)
+    if warm:
+        warm_up(app)
+    return app
+
 def not_found_error(error):
     return jsonify({"error": "未找到请求的资源"}), 404
 
-@app.errorhandler(500)
 def internal_error(error):
     return jsonify({"error": "服务器内部错误"}), 500
 
 # 移除全局 CORS 头，因为已经由 CORS 中间件处理
-@app.after_request
 def after_request(response):
     return response
 
 # 移除 OPTIONS 请求处理，因为已经由 CORS 中间件处理
-@app.route('/get-data', methods=['OPTIONS'])
+@sensor.route('/get-data', methods=['OPTIONS'])
 def handle_options():
     return jsonify({'message': 'OK'})
 
@@ -87,60 +114,160 @@ aes_key = bytes([
     0x35, 0x36, 0x37, 0x38, 0x39, 0x30, 0x31, 0x32
 ])
 
-# 数据库配置
-DB_NAME = 'sensor_data.db'
+# 数据库配置（DB_NAME 为默认值，应用实际使用 app.config['DB_NAME']）
+DB_NAME = os.environ.get('DB_NAME', 'sensor_data.db')
+LEGACY_USER_DB = 'esp32.db'  # 旧版本中用户表所在的数据库文件
+MAX_INGEST_BYTES = 10 * 1024 * 1024  # 批量接口请求体（解压前后）的大小上限
 BACKUP_DIR = 'backups'
 AGGREGATE_INTERVAL = 3600  # 1小时
 CLEANUP_THRESHOLD = 30  # 30天
 MAX_RETRIES = 3
 RETRY_DELAY = 1  # 秒
 
-def init_database():
-    """初始化数据库和必要的表"""
+def migrate_sensor_tables(conn, app):
+    """迁移1：创建传感器数据表、聚合数据表和索引"""
+    # 逐条执行而不是 executescript，后者会提前提交 migrate_database 的事务
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            temperature REAL,
+            humidity REAL,
+            timestamp INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS aggregated_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            interval_start INTEGER,
+            interval_end INTEGER,
+            avg_temperature REAL,
+            avg_humidity REAL,
+            min_temperature REAL,
+            max_temperature REAL,
+            min_humidity REAL,
+            max_humidity REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON sensor_data(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON sensor_data(created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_interval ON aggregated_data(interval_start, interval_end)")
+
+def migrate_users(conn, app):
+    """迁移2：创建用户表，并导入旧 esp32.db 中的用户"""
+    # 与 models.user.User 的定义保持一致
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER NOT NULL,
+            username VARCHAR(80) NOT NULL,
+            password_hash VARCHAR(128) NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (username)
+        )
+    """)
+
+    # Flask-SQLAlchemy 将相对 sqlite 路径解析到应用根目录
+    legacy_path = os.path.join(app.root_path, LEGACY_USER_DB)
+    if not os.path.exists(legacy_path) or os.path.abspath(legacy_path) == os.path.abspath(app.config['DB_NAME']):
+        return
+
+    # 事务中不能 ATTACH，因此用单独的只读连接读取旧用户
+    legacy = sqlite3.connect(f"file:{legacy_path}?mode=ro", uri=True)
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # 创建主数据表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                temperature REAL,
-                humidity REAL,
-                timestamp INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # 创建聚合数据表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS aggregated_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                interval_start INTEGER,
-                interval_end INTEGER,
-                avg_temperature REAL,
-                avg_humidity REAL,
-                min_temperature REAL,
-                max_temperature REAL,
-                min_humidity REAL,
-                max_humidity REAL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # 创建索引
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON sensor_data(timestamp)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON sensor_data(created_at)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_interval ON aggregated_data(interval_start, interval_end)")
-        
-        conn.commit()
-        conn.close()
+        has_users = legacy.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+        ).fetchone()
+        users = legacy.execute(
+            "SELECT id, username, password_hash, created_at FROM users"
+        ).fetchall() if has_users else []
+    finally:
+        legacy.close()
+
+    # 保留原 id，已有会话中的 session['user_id'] 仍指向同一用户
+    cursor = conn.executemany("""
+        INSERT OR IGNORE INTO users (id, username, password_hash, created_at)
+        VALUES (?, ?, ?, ?)
+    """, users)
+    logger.info(f"从 {legacy_path} 导入 {cursor.rowcount} 个用户")
+
+def migrate_reading_id(conn, app):
+    """迁移3：为边缘网关转发的数据添加唯一 reading_id，用于去重"""
+    conn.execute("ALTER TABLE sensor_data ADD COLUMN reading_id TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_reading_id ON sensor_data(reading_id)")
+
+# 按顺序执行的迁移，已执行的版本号记录在 PRAGMA user_version 中
+MIGRATIONS = [
+    migrate_sensor_tables,
+    migrate_users,
+    migrate_reading_id,
+]
+
+def migrate_database(app):
+    """执行数据库迁移（幂等，多个进程同时启动时串行执行）"""
+    from sqlalchemy.exc import IntegrityError
+    from database import db
+    from models.user import User
+
+    try:
+        # 自动提交模式下手动控制事务；BEGIN IMMEDIATE 取得写锁，其他进程在此等待
+        conn = sqlite3.connect(app.config['DB_NAME'], timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for target, migration in enumerate(MIGRATIONS, start=1):
+                    if version < target:
+                        migration(conn, app)
+                        conn.execute(f"PRAGMA user_version = {target}")
+                        logger.info(f"数据库迁移到版本 {target}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        # 创建默认管理员账户（其他进程可能同时创建，唯一约束冲突时忽略）
+        with app.app_context():
+            if not User.query.filter_by(username='admin').first():
+                admin = User(username='admin')
+                admin.set_password('admin123')
+                db.session.add(admin)
+                try:
+                    db.session.commit()
+                    logger.info("创建默认管理员账户成功")
+                except IntegrityError:
+                    db.session.rollback()
+
         logger.info("数据库初始化成功")
     except Exception as e:
         logger.error(f"数据库初始化失败: {str(e)}")
         raise
 
-def create_backup():
+def warm_up(app):
+    """预热：加载加密模块、预先建立数据库连接并预读热点数据，完成后标记就绪"""
+    from Crypto.Cipher import AES  # noqa: F401  提前导入，避免首个请求承担导入开销
+    from database import db
+
+    with app.app_context():
+        # 预先建立连接池中的连接
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql("SELECT 1")
+
+    # 预读首页查询涉及的索引和数据页，填充 sqlite 页缓存
+    conn = sqlite3.connect(app.config['DB_NAME'])
+    try:
+        conn.execute("SELECT temperature, humidity, timestamp FROM sensor_data ORDER BY timestamp DESC LIMIT 20").fetchall()
+        conn.execute("SELECT MAX(interval_end) FROM aggregated_data").fetchone()
+    finally:
+        conn.close()
+
+    app.config['READY'] = True
+    logger.info("服务预热完成，已就绪")
+
+def create_backup(db_name):
     """创建数据库备份"""
     try:
         if not os.path.exists(BACKUP_DIR):
@@ -149,7 +276,7 @@ def create_backup():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_file = os.path.join(BACKUP_DIR, f'sensor_data_{timestamp}.db')
         
-        shutil.copy2(DB_NAME, backup_file)
+        shutil.copy2(db_name, backup_file)
         logger.info(f"数据库备份创建成功: {backup_file}")
         
         # 清理旧备份（保留最近7天的备份）
@@ -170,10 +297,10 @@ def cleanup_old_backups():
     except Exception as e:
         logger.error(f"清理旧备份失败: {str(e)}")
 
-def cleanup_old_data():
+def cleanup_old_data(db_name):
     """清理旧数据"""
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(db_name)
         cursor = conn.cursor()
         
         cutoff_timestamp = int((datetime.now() - timedelta(days=CLEANUP_THRESHOLD)).timestamp())
@@ -185,10 +312,10 @@ def cleanup_old_data():
     except Exception as e:
         logger.error(f"清理旧数据失败: {str(e)}")
 
-def aggregate_data():
+def aggregate_data(db_name):
     """聚合传感器数据"""
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(db_name)
         cursor = conn.cursor()
         
         # 获取最新的聚合时间
@@ -227,19 +354,19 @@ def aggregate_data():
     except Exception as e:
         logger.error(f"数据聚合失败: {str(e)}")
 
-def schedule_maintenance():
+def schedule_maintenance(db_name):
     """调度维护任务"""
     while True:
         try:
             # 每天凌晨2点执行清理和备份
             now = datetime.now()
             if now.hour == 2 and now.minute == 0:
-                cleanup_old_data()
-                create_backup()
+                cleanup_old_data(db_name)
+                create_backup(db_name)
             
             # 每小时聚合数据
             if now.minute == 0:
-                aggregate_data()
+                aggregate_data(db_name)
             
             time.sleep(60)  # 每分钟检查一次
         except Exception as e:
@@ -262,6 +389,8 @@ def decrypt_aes(cipher_text):
             logger.error("无效的Base64编码数据")
             return None
             
+        from Crypto.Cipher import AES  # 延迟导入，首次解密时才加载
+
         cipher_text = b64decode(cipher_text)
         cipher = AES.new(aes_key, AES.MODE_ECB)
         decrypted = cipher.decrypt(cipher_text).decode()
@@ -286,7 +415,7 @@ def save_data(data):
     """保存传感器数据"""
     for attempt in range(MAX_RETRIES):
         try:
-            conn = sqlite3.connect(DB_NAME)
+            conn = sqlite3.connect(current_app.config['DB_NAME'])
             cursor = conn.cursor()
             
             cursor.execute("""
@@ -310,7 +439,7 @@ Flask route to handle incoming POST requests with encrypted sensor data.
 
 :return: JSON response indicating success or error.
 """
-@app.route('/api/post-data', methods=['POST'])
+@sensor.route('/api/post-data', methods=['POST'])
 def receive_data():
     try:
         # 获取原始数据
@@ -342,13 +471,70 @@ def receive_data():
         logger.error(f"数据接收处理失败: {str(e)}")
         return jsonify({"error": "数据接收处理失败"}), 500
 
+def is_valid_reading(reading):
+    """检查批量数据中的单条数据是否为包含数值字段的对象"""
+    if not isinstance(reading, dict):
+        return False
+    for field in ["temperature", "humidity", "timestamp"]:
+        value = reading.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+    return isinstance(reading.get("reading_id"), (str, type(None)))
+
+@sensor.route('/api/ingest-batch', methods=['POST'])
+def ingest_batch():
+    """接收边缘网关转发的批量数据（支持gzip压缩，按 reading_id 去重）"""
+    # 限制请求体和解压后的大小，防止 gzip 炸弹
+    if request.content_length is None or request.content_length > MAX_INGEST_BYTES:
+        return jsonify({"error": "批量数据过大"}), 413
+
+    try:
+        body = request.get_data()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = decompressor.decompress(body, MAX_INGEST_BYTES)
+            if decompressor.unconsumed_tail:
+                return jsonify({"error": "批量数据过大"}), 413
+        readings = json.loads(body).get('readings', [])
+        if not isinstance(readings, list):
+            raise ValueError("readings 不是列表")
+
+        # 跳过非对象或数值无效的数据，避免单条坏数据导致整批失败
+        rows = [(r["temperature"], r["humidity"], r["timestamp"], r.get("reading_id"))
+                for r in readings if is_valid_reading(r)]
+    except Exception as e:
+        logger.error(f"批量数据解析失败: {str(e)}")
+        return jsonify({"error": "无效的批量数据"}), 400
+
+    try:
+        conn = sqlite3.connect(current_app.config['DB_NAME'])
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT OR IGNORE INTO sensor_data (temperature, humidity, timestamp, reading_id)
+            VALUES (?, ?, ?, ?)
+        """, rows)
+        stored = cursor.rowcount
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"批量数据保存失败: {str(e)}")
+        return jsonify({"error": "批量数据保存失败"}), 500
+
+    logger.info(f"批量保存 {stored} 条数据，忽略 {len(rows) - stored} 条重复数据，跳过 {len(readings) - len(rows)} 条无效数据")
+    return jsonify({
+        "message": "批量数据接收成功",
+        "stored": stored,
+        "duplicates": len(rows) - stored,
+        "skipped": len(readings) - len(rows)
+    })
+
 """
 Flask route to retrieve all sensor data from the SQLite database.
 """
-@app.route('/api/get-data', methods=['GET'])
+@sensor.route('/api/get-data', methods=['GET'])
 def get_data():
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(current_app.config['DB_NAME'])
         cursor = conn.cursor()
         
         # 获取最近的20条数据
@@ -374,10 +560,10 @@ def get_data():
         logger.error(f"获取数据失败: {str(e)}")
         return jsonify({'error': '获取数据失败'}), 500
 
-@app.route('/api/get-aggregated-data', methods=['GET'])
+@sensor.route('/api/get-aggregated-data', methods=['GET'])
 def get_aggregated_data():
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(current_app.config['DB_NAME'])
         cursor = conn.cursor()
         
         # 获取最近24小时的聚合数据
@@ -417,10 +603,10 @@ def get_aggregated_data():
         logger.error(f"获取聚合数据失败: {str(e)}")
         return jsonify({'error': '获取聚合数据失败'}), 500
 
-@app.route('/api/search-temperature', methods=['GET'])
+@sensor.route('/api/search-temperature', methods=['GET'])
 def search_temperature():
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(current_app.config['DB_NAME'])
         cursor = conn.cursor()
         
         threshold = request.args.get('threshold', type=float)
@@ -455,27 +641,22 @@ def search_temperature():
         logger.error(f"搜索温度数据失败: {str(e)}")
         return jsonify({'error': '搜索温度数据失败'}), 500
 
-# 创建数据库表
-with app.app_context():
-    db.create_all()
-    
-    # 创建默认管理员账户
-    if not User.query.filter_by(username='admin').first():
-        admin = User(username='admin')
-        admin.set_password('admin123')
-        db.session.add(admin)
-        db.session.commit()
-        logger.info("创建默认管理员账户成功")
+@sensor.route('/api/ready', methods=['GET'])
+def ready():
+    """就绪检查：应用未预热（create_app(warm=False)）时返回503"""
+    if not current_app.config.get('READY'):
+        return jsonify({'status': 'starting'}), 503
+    return jsonify({'status': 'ready'})
 
 """
 Main entry point: Starts the Flask server on port 8888, accessible to all network devices.
 """
 if __name__ == "__main__":
-    # 初始化数据库
-    init_database()
+    # 创建应用（配置日志、迁移数据库并预热）
+    app = create_app()
     
     # 启动维护任务线程
-    maintenance_thread = threading.Thread(target=schedule_maintenance, daemon=True)
+    maintenance_thread = threading.Thread(target=schedule_maintenance, args=(app.config['DB_NAME'],), daemon=True)
     maintenance_thread.start()
     
     # 启动Flask服务器